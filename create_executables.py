@@ -8,54 +8,98 @@ import os
 import sys
 import subprocess
 import shutil
+import multiprocessing
+
+# Modules none of the scripts use; keeping them out shrinks the exes and speeds startup
+EXCLUDED_MODULES = ["unittest", "test", "pydoc_data", "xmlrpc", "numpy", "PIL"]
+
+# Fork where it is safe so build processes inherit the already-imported PyInstaller
+_mp = multiprocessing.get_context("fork" if sys.platform.startswith("linux") else "spawn")
 
 def check_pyinstaller():
     """Check if PyInstaller is installed"""
     try:
-        import PyInstaller
+        import PyInstaller.__main__  # imported once here and reused by forked builds
         return True
     except ImportError:
         print("PyInstaller not found. Installing...")
         subprocess.check_call([sys.executable, "-m", "pip", "install", "pyinstaller"])
+        import PyInstaller.__main__
         return True
 
+def _fast_rmtree(path):
+    """Remove a directory tree with the platform's native command"""
+    if not os.path.exists(path):
+        return
+    if os.name == "nt":
+        cmd = ["cmd", "/c", "rmdir", "/s", "/q", path]
+    else:
+        cmd = ["rm", "-rf", "--", path]
+    try:
+        subprocess.run(cmd, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        shutil.rmtree(path, ignore_errors=True)
+
+def _run_pyinstaller(argv):
+    """Run PyInstaller in the current process (build process target)"""
+    from PyInstaller.__main__ import run
+    run(argv)
+
 def create_executable(script_path, output_name=None, icon=None):
-    """Create executable from Python script"""
+    """Start building an executable from Python script; returns the build process"""
     if not os.path.exists(script_path):
         print(f"Error: {script_path} not found")
-        return False
+        return None
         
     script_name = os.path.basename(script_path).replace('.py', '')
     if not output_name:
         output_name = script_name
+    is_gui = script_name == "file_client_gui"
         
     print(f"Creating executable for {script_name}...")
     
-    # PyInstaller command
-    cmd = [
-        "pyinstaller",
+    # PyInstaller arguments
+    argv = [
         "--onefile",  # Create single executable
-        "--windowed" if script_name == "file_client_gui" else "--console",  # GUI vs console
+        "--windowed" if is_gui else "--console",  # GUI vs console
         "--name", output_name,
         "--distpath", "executables",
-        "--workpath", "build",
-        "--specpath", "spec"
+        # Per-build work/spec dirs so parallel builds never touch each other's files
+        "--workpath", os.path.join("build", output_name),
+        "--specpath", os.path.join("spec", output_name)
     ]
     
+    excluded = EXCLUDED_MODULES if is_gui else EXCLUDED_MODULES + ["tkinter"]
+    for module in excluded:
+        argv.append(f"--exclude-module={module}")
+        
+    if is_gui:
+        argv.append("--optimize=2")  # Strip asserts and docstrings
+        
+    # Compress the bundled binaries when UPX is installed
+    upx = shutil.which("upx")
+    if upx:
+        argv.extend(["--upx-dir", os.path.dirname(upx)])
+    
     if icon and os.path.exists(icon):
-        cmd.extend(["--icon", icon])
+        argv.extend(["--icon", icon])
         
-    cmd.append(script_path)
+    argv.append(script_path)
     
-    try:
-        subprocess.run(cmd, check=True, capture_output=True, text=True)
-        print(f"✅ Successfully created {output_name}.exe")
+    # PyInstaller mutates module globals, so each build gets its own process;
+    # its output goes straight to this console
+    process = _mp.Process(target=_run_pyinstaller, args=(argv,), name=output_name)
+    process.start()
+    return process
+
+def wait_for_executable(process):
+    """Wait for a build process to finish; returns True on success"""
+    process.join()
+    if process.exitcode == 0:
+        print(f"✅ Successfully created {process.name}.exe")
         return True
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Error creating executable: {e}")
-        print(f"STDOUT: {e.stdout}")
-        print(f"STDERR: {e.stderr}")
-        return False
+    print(f"❌ Error creating {process.name}: PyInstaller exited with code {process.exitcode}")
+    return False
 
 def create_batch_files():
     """Create batch files for easy execution"""
@@ -95,6 +139,9 @@ def create_batch_files():
 
 def main():
     """Main function to create all executables"""
+    # build/ holds PyInstaller's analysis cache; keep it between runs unless asked
+    clean = "--clean" in sys.argv[1:]
+    
     print("🚀 Creating executables for Multi-Room File Sharing System...")
     
     # Check PyInstaller
@@ -103,9 +150,8 @@ def main():
         return
         
     # Create directories
-    os.makedirs("executables", exist_ok=True)
-    os.makedirs("build", exist_ok=True)
-    os.makedirs("spec", exist_ok=True)
+    for directory in ("executables", "build", "spec"):
+        os.makedirs(directory, exist_ok=True)
     
     # Scripts to convert
     scripts = [
@@ -114,12 +160,16 @@ def main():
         ("file_client_gui.py", "File_Sharing_Client")
     ]
     
+    # Builds are independent, so run up to one per CPU side by side
+    workers = min(len(scripts), os.cpu_count() or 1)
     success_count = 0
+    for start in range(0, len(scripts), workers):
+        builds = [create_executable(script, output_name)
+                  for script, output_name in scripts[start:start + workers]]
+        for process in builds:
+            if process and wait_for_executable(process):
+                success_count += 1
     
-    for script, output_name in scripts:
-        if create_executable(script, output_name):
-            success_count += 1
-            
     print(f"\n📊 Results: {success_count}/{len(scripts)} executables created successfully")
     
     if success_count == len(scripts):
@@ -128,11 +178,10 @@ def main():
         # Create batch files
         create_batch_files()
         
-        # Clean up build files
-        if os.path.exists("build"):
-            shutil.rmtree("build")
-        if os.path.exists("spec"):
-            shutil.rmtree("spec")
+        # Clean up build files; build/ is reused by the next run unless --clean
+        _fast_rmtree("spec")
+        if clean:
+            _fast_rmtree("build")
             
         print("\n📁 Executables are located in the 'executables' folder")
         print("📁 Batch files are created for easy execution")
@@ -8,12 +8,29 @@ import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, scrolledtext
 import socket
 import threading
-import json
-import base64
+import queue
+import hashlib
 import time
 import os
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
+from protocol import (
+    dumps, loads, OP_JSON, OP_FILE, FILE_CHUNK_SIZE, FRAME_HDR, SIZE_FIELD,
+    UDP_HEARTBEAT, HEARTBEAT_INTERVAL
+)
+
+# Set to True to log every TCP/UDP message to the console
+DEBUG = False
+
+logger = logging.getLogger(__name__)
+
+SENDMSG_THRESHOLD = 64 * 1024  # gather large frames with sendmsg instead of concatenating
+SOCKET_BUFFER_SIZE = 1024 * 1024
+UI_PUMP_INTERVAL_MS = 50
+MAX_NOTIFICATION_LINES = 1000
+
 class FileSharingClient:
     def __init__(self, root):
         self.root = root
@@ -24,7 +41,9 @@ class FileSharingClient:
         self.tcp_host = '127.0.0.1'
         self.tcp_port = 65432
         self.udp_host = '127.0.0.1'
-        self.udp_port = 65433
+        self.udp_server_port = 65433
+        self.udp_server_addr = (self.udp_host, self.udp_server_port)
+        self.udp_local_port = None  # port our UDP listener is bound to
         
         # Client state
         self.tcp_socket = None
@@ -33,15 +52,26 @@ class FileSharingClient:
         self.username = None
         self.current_room = None
         self.connected = False
-        self.pending_downloads = {}  # filename -> save_path
+        self.active_downloads = {}  # filename -> save path, until the server's file frame arrives
+        self._users_set = set()  # mirrors users_listbox for O(1) membership checks
+        self._files_set = set()  # mirrors file_listbox
         self.udp_listener_thread = None
         self.tcp_receiver_thread = None
+        self._receiver_ready = threading.Event()
+        self._send_lock = threading.Lock()  # keeps frames from different threads whole
+        self.send_queue = None  # control frames for this session's sender thread
+        
+        # Blocking file I/O runs here so the Tk main loop keeps pumping
+        self.io_pool = ThreadPoolExecutor(max_workers=2)
+        
+        # Network threads never touch Tk widgets; they queue (op, arg) updates
+        # that pump_ui_queue applies on the main thread
+        self.ui_queue = queue.SimpleQueue()
         
         # Setup GUI
         self.setup_gui()
-        
-        # Start UDP listener thread
-        self.start_udp_listener()
+        self.root.after(UI_PUMP_INTERVAL_MS, self.pump_ui_queue)
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
         
     def setup_gui(self):
         """Setup the GUI layout"""
@@ -115,7 +145,7 @@ class FileSharingClient:
         # Notifications
         ttk.Label(right_frame, text="Notifications:").grid(row=2, column=0, sticky=tk.W, pady=(10, 0))
         
-        self.notifications_text = scrolledtext.ScrolledText(right_frame, height=12, width=30, wrap=tk.WORD)
+        self.notifications_text = scrolledtext.ScrolledText(right_frame, height=12, width=30, wrap=tk.WORD, undo=False)
         self.notifications_text.grid(row=3, column=0, sticky=(tk.W, tk.E, tk.N, tk.S), pady=5)
         self.notifications_text.config(state=tk.DISABLED)
         
@@ -149,7 +179,16 @@ class FileSharingClient:
         try:
             # Connect to TCP server
             self.tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # Set before connecting so the larger receive window is negotiated
+            self.tcp_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
             self.tcp_socket.connect((self.tcp_host, self.tcp_port))
+            # Control messages are small; don't let Nagle hold them back
+            self.tcp_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            
+            # Control frames are written by a sender thread so the GUI never
+            # waits behind an upload that holds the socket
+            self.send_queue = queue.SimpleQueue()
+            threading.Thread(target=self.tcp_sender, args=(self.send_queue, self.tcp_socket), daemon=True).start()
             
             # Set username
             self.send_tcp_message({
@@ -157,24 +196,23 @@ class FileSharingClient:
                 'username': username
             })
             
-            # Create UDP socket
-            self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            
             self.username = username
             self.client_id = f"client_{int(time.time())}"  # Generate unique client ID
             self.connected = True
             self.status_label.config(text="Connected", foreground="green")
             
+            # Open UDP socket and start listening for notifications
+            self.start_udp_listener()
+            
             # Register with UDP server
             self.register_with_udp()
             
-            # Start TCP receiver thread
+            # Start TCP receiver thread and wait until it is receiving
+            self._receiver_ready.clear()
             self.tcp_receiver_thread = threading.Thread(target=self.tcp_receiver)
             self.tcp_receiver_thread.daemon = True
             self.tcp_receiver_thread.start()
-            
-            # Small delay to ensure TCP receiver is ready
-            time.sleep(0.1)
+            self._receiver_ready.wait(timeout=2.0)
             
             # Set default room list initially
             self.room_combo['values'] = ['general']
@@ -197,32 +235,55 @@ class FileSharingClient:
                 'username': self.username,
                 'room': self.current_room or 'general',
                 'client_id': self.client_id,
-                'udp_port': self.udp_port  # Send the actual UDP port we're listening on
+                'udp_port': self.udp_local_port  # Send the actual UDP port we're listening on
             }
             self.send_udp_message(message)
             
     def start_udp_listener(self):
-        """Start UDP listener thread"""
+        """Open the UDP socket and start its listener thread"""
+        udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udp_socket.bind(('', 0))  # Bind to any available port
+        # Connected UDP: the kernel caches the route and only accepts server datagrams
+        udp_socket.connect(self.udp_server_addr)
+        # Wake up periodically so the listener notices a disconnect
+        udp_socket.settimeout(0.5)
+        
+        # Store the actual port for registration
+        self.udp_local_port = udp_socket.getsockname()[1]
+        self.udp_socket = udp_socket
+        logger.debug("🟢 [UDP] Listening on port %s", self.udp_local_port)
+        
         def udp_listener():
-            if not self.udp_socket:
-                self.udp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                self.udp_socket.bind(('', 0))  # Bind to any available port
-                
-                # Store the actual port for registration
-                self.udp_port = self.udp_socket.getsockname()[1]
-                print(f"🟢 [UDP] Listening on port {self.udp_port}")
-                
-            while self.connected:
+            json_loads = loads
+            heartbeat = bytes([UDP_HEARTBEAT]) + self.client_id.encode('utf-8')
+            next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+            # Each session owns its socket; a reconnect installs a new one
+            while self.connected and self.udp_socket is udp_socket:
+                # Keep our registration alive; the timeout below wakes us often enough
+                if time.monotonic() >= next_heartbeat:
+                    next_heartbeat += HEARTBEAT_INTERVAL
+                    try:
+                        udp_socket.send(heartbeat)
+                    except OSError as e:
+                        logger.debug("🟢 [UDP] Heartbeat failed: %s", e)
                 try:
-                    data, addr = self.udp_socket.recvfrom(4096)
-                    message = json.loads(data.decode('utf-8'))
-                    self.handle_udp_message(message)
+                    data, addr = udp_socket.recvfrom(4096)
                 except socket.timeout:
                     continue
-                except Exception as e:
-                    if self.connected:  # Only log if we're supposed to be connected
-                        print(f"UDP listener error: {e}")
-                    time.sleep(1)
+                except OSError as e:
+                    # Socket closed by disconnect, or replaced by a newer session
+                    if (not self.connected or self.udp_socket is not udp_socket
+                            or udp_socket.fileno() == -1):
+                        return
+                    logger.error("UDP listener error: %s", e)
+                    continue
+                    
+                try:
+                    message = json_loads(data)
+                except ValueError as e:
+                    logger.error("UDP listener error: %s", e)
+                    continue
+                self.ui_queue.put(('udp', message))
                     
         self.udp_listener_thread = threading.Thread(target=udp_listener)
         self.udp_listener_thread.daemon = True
@@ -231,24 +292,24 @@ class FileSharingClient:
     def handle_udp_message(self, message):
         """Handle incoming UDP notification message"""
         msg_type = message.get('type')
-        print(f"🟢 [UDP] Received: {message}")  # Debug
+        logger.debug("🟢 [UDP] Received: %s", message)
         
         if msg_type == 'notification':
             self.add_notification(message.get('message', ''))
             users = message.get('users', [])
             if users:
-                print(f"👥 [USERS] Updating from notification: {users}")  # Debug
+                logger.debug("👥 [USERS] Updating from notification: %s", users)
                 self.update_users_list(users)
             
         elif msg_type == 'room_info':
             users = message.get('users', [])
             if users:
-                print(f"👥 [USERS] Updating from room_info: {users}")  # Debug
+                logger.debug("👥 [USERS] Updating from room_info: %s", users)
                 self.update_users_list(users)
             # Also add current user if not in list
-            current_users = list(self.users_listbox.get(0, tk.END))
-            if self.username not in current_users:
+            if self.username not in self._users_set:
                 self.users_listbox.insert(tk.END, self.username)
+                self._users_set.add(self.username)
             
         elif msg_type == 'chat':
             username = message.get('username', '')
@@ -257,37 +318,112 @@ class FileSharingClient:
             
     def tcp_receiver(self):
         """Receive messages from TCP server"""
+        json_loads = loads
+        self._receiver_ready.set()
         while self.connected and self.tcp_socket:
             try:
-                # Receive message length
-                length_data = self.tcp_socket.recv(4)
-                if not length_data:
+                # Receive frame opcode and message length, then the message itself
+                frame_header = self.recv_exact(FRAME_HDR.size)
+                if frame_header is None:
+                    break
+                    
+                opcode, message_length = FRAME_HDR.unpack(frame_header)
+                message_data = self.recv_exact(message_length)
+                if message_data is None:
                     break
                     
-                message_length = int.from_bytes(length_data, byteorder='big')
+                message = json_loads(message_data)
                 
-                # Receive actual message
-                message_data = b''
-                while len(message_data) < message_length:
-                    chunk = self.tcp_socket.recv(min(4096, message_length - len(message_data)))
-                    if not chunk:
+                if opcode == OP_FILE:
+                    # Raw file bytes follow the JSON header
+                    size_data = self.recv_exact(SIZE_FIELD.size)
+                    if size_data is None:
                         break
-                    message_data += chunk
-                    
-                if len(message_data) == message_length:
-                    message = json.loads(message_data.decode('utf-8'))
-                    self.handle_tcp_message(message)
+                    (size,) = SIZE_FIELD.unpack(size_data)
+                    self.receive_file(message, size)
+                else:
+                    self.ui_queue.put(('tcp', message))
                     
             except Exception as e:
-                print(f"TCP receiver error: {e}")
+                logger.error("TCP receiver error: %s", e)
                 break
                 
         self.connected = False
-        self.status_label.config(text="Disconnected", foreground="red")
+        self.ui_queue.put(('status', ("Disconnected", "red")))
+        
+    def recv_exact(self, size):
+        """Receive exactly size bytes from TCP server, or None if the connection closed"""
+        buf = bytearray(size)
+        view = memoryview(buf)
+        offset = 0
+        while offset < size:
+            received = self.tcp_socket.recv_into(view[offset:], size - offset)
+            if not received:
+                return None
+            offset += received
+        return buf
+        
+    def receive_file(self, header, size):
+        """Stream an incoming file frame straight into its download file"""
+        filename = header.get('filename')
+        save_path = self.active_downloads.pop(filename, None)
+        logger.debug("🔵 [TCP] Receiving file: %s (%s bytes)", filename, size)
+        
+        expected = save_path is not None
+        error = None if expected else f"Received unexpected file data for {filename}"
+        
+        # Only now that the server is actually sending do we touch the destination
+        fd = None
+        if expected:
+            try:
+                flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+                fd = os.open(save_path, flags)
+            except OSError as e:
+                error = f"Failed to save {filename}: {str(e)}"
+                
+        # Verify the server's checksum while the bytes stream past
+        checksum = header.get('sha256')
+        digest = hashlib.sha256() if checksum and expected else None
         
+        try:
+            # Payload is always drained so the next frame stays aligned
+            buf = memoryview(bytearray(min(FILE_CHUNK_SIZE, size)))
+            remaining = size
+            while remaining:
+                received = self.tcp_socket.recv_into(buf, min(len(buf), remaining))
+                if not received:
+                    raise ConnectionError("Connection closed during download")
+                remaining -= received
+                if expected:
+                    self.ui_queue.put(('progress', ("Downloading", filename, size - remaining, size)))
+                if digest is not None:
+                    digest.update(buf[:received])
+                if fd is not None:
+                    try:
+                        os.write(fd, buf[:received])
+                    except OSError as e:
+                        error = f"Failed to save {filename}: {str(e)}"
+                        os.close(fd)
+                        fd = None
+        finally:
+            if fd is not None:
+                os.close(fd)
+                
+        if not error and digest is not None and digest.hexdigest() != checksum:
+            error = f"Checksum mismatch for {filename}; the download is corrupt"
+            
+        if not expected:
+            self.add_notification(error)
+        elif error:
+            self.add_notification(error)
+            self.ui_queue.put(('error', ("Download Error", error)))
+        else:
+            self.add_notification(f"Successfully downloaded {filename}")
+            self.ui_queue.put(('info', ("Success", f"File {filename} downloaded successfully!")))
+            
     def handle_tcp_message(self, message):
         """Handle incoming TCP message"""
-        print(f"🔵 [TCP] Received: {message}")  # Debug
+        logger.debug("🔵 [TCP] Received: %s", message)
         status = message.get('status')
         
         if status == 'success':
@@ -330,27 +466,6 @@ class FileSharingClient:
                     'client_id': self.client_id
                 })
                 
-            # Handle file download response
-            elif 'filename' in message and 'data' in message:
-                filename = message.get('filename')
-                file_data = message.get('data')
-                
-                if filename in self.pending_downloads:
-                    save_path = self.pending_downloads.pop(filename)
-                    try:
-                        # Decode base64 data and save file
-                        import base64
-                        file_content = base64.b64decode(file_data)
-                        with open(save_path, 'wb') as f:
-                            f.write(file_content)
-                        self.add_notification(f"Successfully downloaded {filename}")
-                        messagebox.showinfo("Success", f"File {filename} downloaded successfully!")
-                    except Exception as e:
-                        self.add_notification(f"Failed to save {filename}: {str(e)}")
-                        messagebox.showerror("Download Error", f"Failed to save file: {str(e)}")
-                else:
-                    self.add_notification(f"Received unexpected file data for {filename}")
-                
             elif 'uploaded' in msg_type:
                 # Refresh files immediately
                 self.refresh_files()
@@ -359,9 +474,9 @@ class FileSharingClient:
                 # Also manually add the file to the list if upload
                 filename = msg_type.split()[-1]
                 # Add file to list immediately
-                current_files = list(self.file_listbox.get(0, tk.END))
-                if filename not in current_files:
+                if filename not in self._files_set:
                     self.file_listbox.insert(tk.END, filename)
+                    self._files_set.add(filename)
                 
                 # Notify UDP server about file activity
                 self.send_udp_message({
@@ -381,48 +496,105 @@ class FileSharingClient:
                 files = message.get('files', [])
                 file_names = [file['name'] for file in files]
                 self.update_file_list(file_names)
-                print(f"Updated file list with: {file_names}")  # Debug
+                logger.debug("Updated file list with: %s", file_names)
                     
         elif status == 'error':
             messagebox.showerror("Error", message.get('message', 'Unknown error'))
             
     def send_tcp_message(self, message):
-        """Send message to TCP server"""
-        if self.tcp_socket and self.connected:
+        """Queue a message for the TCP server; never blocks the caller"""
+        send_queue = self.send_queue
+        if self.tcp_socket and send_queue is not None:
+            logger.debug("🔵 [TCP] Sending: %s", message)
+            message_json = dumps(message)
+            send_queue.put((FRAME_HDR.pack(OP_JSON, len(message_json)), message_json))
+            
+    def tcp_sender(self, send_queue, tcp_socket):
+        """Write queued control frames to one session's TCP socket"""
+        while True:
+            frame = send_queue.get()
+            if frame is None:
+                return
             try:
-                print(f"🔵 [TCP] Sending: {message}")  # Debug
-                message_json = json.dumps(message).encode('utf-8')
-                length = len(message_json)
-                
-                self.tcp_socket.send(length.to_bytes(4, byteorder='big'))
-                self.tcp_socket.send(message_json)
+                with self._send_lock:
+                    self.send_frame(tcp_socket, *frame)
             except Exception as e:
-                print(f"🔴 [TCP] Send error: {e}")
+                logger.error("🔴 [TCP] Send error: %s", e)
+                # A frame may be half written; the stream can't be trusted now
+                self.abort_connection(tcp_socket)
+                return
                 
+    def abort_connection(self, tcp_socket):
+        """Drop a TCP connection whose framing is broken (safe from any thread)"""
+        try:
+            tcp_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        # The GUI thread tears the session down, unless a newer one replaced it
+        self.ui_queue.put(('disconnect', tcp_socket))
+        
+    def send_binary_message(self, tcp_socket, header, f, size, progress=None):
+        """Send a JSON header followed by size raw bytes of file f on tcp_socket
+
+        Raises on failure. Once the header is out the server expects exactly
+        size bytes, so a failure part-way through also drops the connection.
+        """
+        if not (tcp_socket and self.connected and tcp_socket is self.tcp_socket):
+            raise ConnectionError("Not connected to server")
+            
+        logger.debug("🔵 [TCP] Sending: %s", header)
+        header_json = dumps(header)
+        
+        with self._send_lock:
+            try:
+                self.send_frame(
+                    tcp_socket,
+                    FRAME_HDR.pack(OP_FILE, len(header_json)),
+                    header_json + SIZE_FIELD.pack(size)
+                )
+                
+                # Kernel copies the file straight into the socket where supported
+                sent = 0
+                while sent < size:
+                    count = tcp_socket.sendfile(f, sent, min(FILE_CHUNK_SIZE, size - sent))
+                    if not count:
+                        raise EOFError("File shrank during upload")
+                    sent += count
+                    if progress:
+                        progress(sent, size)
+            except Exception:
+                self.abort_connection(tcp_socket)
+                raise
+                
+    def send_frame(self, tcp_socket, prefix, payload):
+        """Send a frame prefix and payload on tcp_socket in as few syscalls as possible"""
+        if len(payload) < SENDMSG_THRESHOLD or not hasattr(tcp_socket, 'sendmsg'):
+            tcp_socket.sendall(prefix + payload)
+            return
+            
+        # Let the kernel gather both buffers instead of copying them together
+        sent = tcp_socket.sendmsg([prefix, payload])
+        if sent < len(prefix):
+            tcp_socket.sendall(prefix[sent:])
+            tcp_socket.sendall(payload)
+        elif sent < len(prefix) + len(payload):
+            tcp_socket.sendall(memoryview(payload)[sent - len(prefix):])
+            
     def send_udp_message(self, message):
         """Send message to UDP server"""
         if self.udp_socket:
             try:
-                print(f"🟢 [UDP] Sending: {message}")  # Debug
-                message_json = json.dumps(message).encode('utf-8')
-                self.udp_socket.sendto(message_json, (self.udp_host, self.udp_port))
+                logger.debug("🟢 [UDP] Sending: %s", message)
+                message_json = dumps(message)
+                self.udp_socket.send(message_json)
             except Exception as e:
-                print(f"🔴 [UDP] Send error: {e}")
+                logger.error("🔴 [UDP] Send error: %s", e)
                 
     def refresh_rooms(self):
         """Refresh list of available rooms"""
         if self.connected:
+            # The room list is updated when the server's response is pumped
             self.send_tcp_message({'type': 'list_rooms'})
-            # Add a small delay to wait for response
-            self.root.after(100, self.check_room_update)
-            
-    def check_room_update(self):
-        """Check if room list was updated, fallback to default if needed"""
-        if not self.room_combo['values']:
-            # Fallback to default rooms if server didn't respond
-            self.room_combo['values'] = ['general']
-            if not self.current_room:
-                self.room_combo.set('general')
             
     def create_room(self):
         """Create a new room"""
@@ -436,22 +608,22 @@ class FileSharingClient:
     def on_room_selected(self, event):
         """Handle room selection"""
         selected_room = self.room_combo.get()
-        print(f"🏠 [ROOM] Selected: {selected_room}")  # Debug
+        logger.debug("🏠 [ROOM] Selected: %s", selected_room)
         if selected_room and self.connected:
-            print(f"🏠 [ROOM] Joining: {selected_room}")  # Debug
+            logger.debug("🏠 [ROOM] Joining: %s", selected_room)
             self.send_tcp_message({
                 'type': 'join_room',
                 'room': selected_room
             })
         else:
-            print(f"🔴 [ROOM] Cannot join - connected: {self.connected}, room: {selected_room}")  # Debug
+            logger.debug("🔴 [ROOM] Cannot join - connected: %s, room: %s", self.connected, selected_room)
             
     def join_current_room(self):
         """Manually join the selected room"""
         selected_room = self.room_combo.get()
-        print(f"🏠 [ROOM] Manual join: {selected_room}")  # Debug
+        logger.debug("🏠 [ROOM] Manual join: %s", selected_room)
         if selected_room and self.connected:
-            print(f"🏠 [ROOM] Manual joining: {selected_room}")  # Debug
+            logger.debug("🏠 [ROOM] Manual joining: %s", selected_room)
             self.send_tcp_message({
                 'type': 'join_room',
                 'room': selected_room
@@ -466,25 +638,78 @@ class FileSharingClient:
             
     def update_file_list(self, files):
         """Update file listbox"""
-        print(f"📁 [FILES] Updating list: {files}")  # Debug
+        logger.debug("📁 [FILES] Updating list: %s", files)
         self.file_listbox.delete(0, tk.END)
-        for filename in files:
-            self.file_listbox.insert(tk.END, filename)
+        self.file_listbox.insert(tk.END, *files)  # one Tcl call for the whole list
+        self._files_set = set(files)
             
     def update_users_list(self, users):
         """Update users listbox"""
-        print(f"👥 [USERS] Updating list: {users}")  # Debug
+        logger.debug("👥 [USERS] Updating list: %s", users)
         self.users_listbox.delete(0, tk.END)
-        for username in users:
-            self.users_listbox.insert(tk.END, username)
+        self.users_listbox.insert(tk.END, *users)
+        self._users_set = set(users)
             
     def add_notification(self, message):
-        """Add notification to the notifications text area"""
+        """Queue a notification for the notifications text area (safe from any thread)"""
         timestamp = datetime.now().strftime("%H:%M:%S")
-        notification = f"[{timestamp}] {message}\n"
+        self.ui_queue.put(('notification', f"[{timestamp}] {message}\n"))
         
+    def pump_ui_queue(self):
+        """Apply queued UI updates on the Tk main thread"""
+        notifications = []
+        try:
+            while True:
+                try:
+                    op, arg = self.ui_queue.get_nowait()
+                except queue.Empty:
+                    break
+                    
+                if op == 'notification':
+                    notifications.append(arg)
+                else:
+                    self.apply_ui_update(op, arg)
+        except Exception:
+            logger.exception("UI update failed")
+        finally:
+            # All notifications from this pass share one insert and one redraw
+            if notifications:
+                self.show_notifications(notifications)
+            self.root.after(UI_PUMP_INTERVAL_MS, self.pump_ui_queue)
+            
+    def apply_ui_update(self, op, arg):
+        """Apply a single queued UI update"""
+        if op == 'tcp':
+            self.handle_tcp_message(arg)
+        elif op == 'udp':
+            self.handle_udp_message(arg)
+        elif op == 'status':
+            text, color = arg
+            self.status_label.config(text=text, foreground=color)
+        elif op == 'progress':
+            action, filename, done, total = arg
+            percent = 100 if not total else done * 100 // total
+            self.file_info_label.config(text=f"{action} {filename}: {percent}%")
+        elif op == 'info':
+            messagebox.showinfo(*arg)
+        elif op == 'error':
+            messagebox.showerror(*arg)
+        elif op == 'disconnect':
+            # The receiver may already have cleared connected; clean up anyway
+            if arg is self.tcp_socket:
+                self.disconnect()
+            
+    def show_notifications(self, notifications):
+        """Append notification lines to the notifications text area"""
         self.notifications_text.config(state=tk.NORMAL)
-        self.notifications_text.insert(tk.END, notification)
+        self.notifications_text.insert(tk.END, ''.join(notifications))
+        
+        # Drop the oldest lines so the widget never grows past its budget
+        line_count = int(self.notifications_text.index('end-1c').split('.')[0]) - 1
+        excess = line_count - MAX_NOTIFICATION_LINES
+        if excess > 0:
+            self.notifications_text.delete('1.0', f'{excess + 1}.0')
+            
         self.notifications_text.see(tk.END)
         self.notifications_text.config(state=tk.DISABLED)
         
@@ -496,26 +721,30 @@ class FileSharingClient:
             
         file_path = filedialog.askopenfilename(title="Select file to upload")
         if file_path:
-            try:
-                filename = os.path.basename(file_path)
-                file_size = os.path.getsize(file_path)
-                
-                # Read file and encode in base64
-                with open(file_path, 'rb') as f:
-                    file_content = f.read()
-                    
-                encoded_data = base64.b64encode(file_content).decode('utf-8')
-                
-                self.send_tcp_message({
-                    'type': 'upload_file',
-                    'filename': filename,
-                    'size': file_size,
-                    'data': encoded_data
-                })
+            self.io_pool.submit(self._do_upload, self.tcp_socket, file_path, self.current_room)
+            
+    def _do_upload(self, tcp_socket, file_path, room):
+        """Stream a file to the server (runs on the I/O pool)"""
+        try:
+            filename = os.path.basename(file_path)
+            file_size = os.path.getsize(file_path)
+            
+            header = {
+                'type': 'upload_file',
+                'filename': filename,
+                'size': file_size,
+                'room': room
+            }
+            
+            def progress(sent, total):
+                self.ui_queue.put(('progress', ("Uploading", filename, sent, total)))
                 
-            except Exception as e:
-                messagebox.showerror("Upload Error", f"Failed to upload file: {str(e)}")
+            with open(file_path, 'rb') as f:
+                self.send_binary_message(tcp_socket, header, f, file_size, progress)
                 
+        except Exception as e:
+            self.ui_queue.put(('error', ("Upload Error", f"Failed to upload file: {str(e)}")))
+            
     def download_file(self):
         """Download selected file"""
         selection = self.file_listbox.curselection()
@@ -531,8 +760,9 @@ class FileSharingClient:
         )
         
         if save_path and self.connected:
-            # Store the pending download path
-            self.pending_downloads[filename] = save_path
+            # The receiver opens save_path when the file frame arrives, so an
+            # error reply leaves any existing file there untouched
+            self.active_downloads[filename] = save_path
             
             self.send_tcp_message({
                 'type': 'download_file',
@@ -545,7 +775,7 @@ class FileSharingClient:
         """Send chat message"""
         message = self.chat_entry.get().strip()
         if message and self.connected:
-            print(f"💬 [CHAT] Sending: {message}")  # Debug
+            logger.debug("💬 [CHAT] Sending: %s", message)
             self.send_udp_message({
                 'type': 'chat_message',
                 'message': message,
@@ -567,6 +797,11 @@ class FileSharingClient:
             except:
                 pass
         
+        # Stop the sender thread
+        if self.send_queue is not None:
+            self.send_queue.put(None)
+            self.send_queue = None
+            
         # Close TCP socket
         if self.tcp_socket:
             try:
@@ -588,11 +823,19 @@ class FileSharingClient:
         self.status_label.config(text="Disconnected", foreground="red")
         self.current_room = None
         self.current_room_label.config(text="Current Room: None")
-        self.pending_downloads.clear()
+        self.active_downloads.clear()
+        
+        logger.debug("🔴 [CLIENT] Disconnected and cleaned up")
         
-        print("🔴 [CLIENT] Disconnected and cleaned up")
+    def on_close(self):
+        """Disconnect and stop background work when the window is closed"""
+        self.disconnect()
+        # Closing the socket aborts any upload still running on the pool
+        self.io_pool.shutdown(wait=False)
+        self.root.destroy()
 
 def main():
+    logging.basicConfig(level=logging.DEBUG if DEBUG else logging.WARNING, format='%(message)s')
     root = tk.Tk()
     app = FileSharingClient(root)
     root.mainloop()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+Multi-Room File Sharing System - Wire Protocol
+Framing constants and message helpers shared by the client and both servers
+"""
+
+import json
+import struct
+import sys
+
+# Use orjson for message encoding when available; both helpers work on bytes
+try:
+    import orjson
+    dumps = orjson.dumps
+    loads = orjson.loads
+except ImportError:
+    def dumps(obj):
+        return json.dumps(obj).encode('utf-8')
+    loads = json.loads
+
+# TCP frame opcodes: every TCP frame starts with one of these bytes
+OP_JSON = 0x00  # 4-byte length + JSON message
+OP_FILE = 0x01  # 4-byte length + JSON header, 8-byte length + raw file bytes
+FILE_CHUNK_SIZE = 1024 * 1024
+
+# Precompiled frame layouts (big-endian)
+FRAME_HDR = struct.Struct('>BI')  # opcode + JSON length
+SIZE_FIELD = struct.Struct('>Q')  # file payload length
+
+# UDP datagrams are JSON unless the first byte is a binary opcode (JSON starts with '{')
+UDP_HEARTBEAT = 0x01  # opcode + UTF-8 client_id
+HEARTBEAT_INTERVAL = 10  # Seconds between client heartbeats
+CLIENT_TIMEOUT = 30  # Seconds without a heartbeat before a client is dropped
+
+def intern_string(value):
+    """Intern strings that are stored long-term; other JSON values pass through"""
+    return sys.intern(value) if type(value) is str else value
@@ -4,13 +4,36 @@ Multi-Room File Sharing System - TCP Server
 Handles file uploads, downloads, and room management
 """
 
+import asyncio
 import socket
-import threading
-import json
 import os
 import time
 from datetime import datetime
 import hashlib
+import re
+import tempfile
+from dataclasses import dataclass
+from concurrent.futures import ThreadPoolExecutor
+
+from protocol import (
+    dumps, loads, intern_string, OP_JSON, OP_FILE, FILE_CHUNK_SIZE, FRAME_HDR, SIZE_FIELD
+)
+
+try:
+    import uvloop  # Faster event loop where available (not on Windows)
+except ImportError:
+    uvloop = None
+
+SOCKET_BUFFER_SIZE = 4 * 1024 * 1024  # Kernel send/receive buffers for accepted sockets
+IO_WORKERS = 8  # Concurrent disk reads/writes; raise for fast SSDs, lower for a single HDD
+
+@dataclass(slots=True)
+class Client:
+    """Per-connection state"""
+    writer: asyncio.StreamWriter
+    address: tuple
+    username: str | None = None
+    room: str | None = None
 
 class FileSharingServer:
     def __init__(self, host='127.0.0.1', port=65432):
@@ -18,13 +41,15 @@ class FileSharingServer:
         self.port = port
         self.clients = {}
         self.rooms = {
-            'general': {'files': {}, 'users': set()}
+            'general': {'files': {}, 'users': set(), 'files_cache': None}
         }
         self.client_id_counter = 0
         self.storage_dir = 'server_files'
         self.ensure_storage_dir()
-        self.server_socket = None
+        self.server = None
         self.running = False
+        # Dedicated pool for blocking file I/O, sized for the disk rather than the CPU
+        self.io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix='file-io')
         
         # File validation settings
         self.max_file_size = 100 * 1024 * 1024  # 100MB
@@ -36,6 +61,8 @@ class FileSharingServer:
             '.py', '.js', '.html', '.css', '.json', '.xml'
         }
         self.blocked_patterns = ['..', '\\', '/', ':', '*', '?', '"', '<', '>', '|']
+        # One regex scan instead of a substring search per pattern
+        self._blocked_re = re.compile('|'.join(map(re.escape, self.blocked_patterns)))
         
     def ensure_storage_dir(self):
         """Create storage directory if it doesn't exist"""
@@ -44,95 +71,129 @@ class FileSharingServer:
             
     def start_server(self):
         """Start the TCP server"""
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
+        run = uvloop.run if uvloop else asyncio.run
+        try:
+            run(self._serve())
+        except KeyboardInterrupt:
+            print("\nServer shutting down...")
+            
+    async def _serve(self):
+        """Accept clients on a single event loop until cancelled"""
+        # Deep accept queue so connection bursts wait in the kernel instead of being refused
+        self.server = await asyncio.start_server(
+            self.handle_client, self.host, self.port, backlog=socket.SOMAXCONN
+        )
         self.running = True
         
         print(f"TCP File Server started on {self.host}:{self.port}")
         print("Waiting for client connections...")
         
         try:
-            while self.running:
-                try:
-                    self.server_socket.settimeout(1.0)  # Set timeout for periodic checks
-                    client_socket, addr = self.server_socket.accept()
-                    
-                    self.client_id_counter += 1
-                    client_id = f"client_{self.client_id_counter}"
-                    
-                    self.clients[client_id] = {
-                        'socket': client_socket,
-                        'address': addr,
-                        'username': None,
-                        'room': None
-                    }
-                    
-                    print(f"New client connected: {client_id} from {addr}")
-                    
-                    # Start client handler thread
-                    client_thread = threading.Thread(
-                        target=self.handle_client, 
-                        args=(client_id,)
-                    )
-                    client_thread.daemon = True
-                    client_thread.start()
-                    
-                except socket.timeout:
-                    continue  # Periodic timeout to check running state
-                except OSError as e:
-                    if self.running:  # Only log if we're supposed to be running
-                        print(f"Socket error: {e}")
-                    break
-                    
-        except KeyboardInterrupt:
-            print("\nServer shutting down...")
+            await self.server.serve_forever()
         finally:
             self.shutdown_server()
             
-    def handle_client(self, client_id):
+    async def handle_client(self, reader, writer):
         """Handle individual client connection"""
-        client = self.clients[client_id]
-        socket = client['socket']
+        self.client_id_counter += 1
+        client_id = f"client_{self.client_id_counter}"
+        addr = writer.get_extra_info('peername')
+        self.tune_connection(writer)
+        
+        self.clients[client_id] = Client(writer, addr)
+        
+        print(f"New client connected: {client_id} from {addr}")
         
         try:
             while True:
-                # Receive message length first
-                length_data = socket.recv(4)
-                if not length_data:
+                # Receive frame opcode and message length, then the message itself
+                frame_header = await reader.readexactly(FRAME_HDR.size)
+                opcode, message_length = FRAME_HDR.unpack(frame_header)
+                if opcode not in (OP_JSON, OP_FILE):
+                    print(f"Unknown frame opcode {opcode} from {client_id}")
                     break
                     
-                message_length = int.from_bytes(length_data, byteorder='big')
+                message_data = await reader.readexactly(message_length)
                 
-                # Receive actual message
-                message_data = b''
-                while len(message_data) < message_length:
-                    chunk = socket.recv(min(4096, message_length - len(message_data)))
-                    if not chunk:
-                        break
-                    message_data += chunk
+                try:
+                    message = loads(message_data)
+                except ValueError:  # Bad JSON or bad UTF-8
+                    message = None
                     
-                if len(message_data) != message_length:
-                    break
+                if opcode == OP_FILE:
+                    # Raw file bytes follow the JSON header
+                    size_data = await reader.readexactly(SIZE_FIELD.size)
+                    (payload_size,) = SIZE_FIELD.unpack(size_data)
+                    if message is None:
+                        await self.receive_payload(reader, None, payload_size)
+                        response = {'status': 'error', 'message': 'Invalid JSON format'}
+                    else:
+                        response = await self.handle_file_upload(client_id, message, reader, payload_size)
+                elif message is None:
+                    response = {'status': 'error', 'message': 'Invalid JSON format'}
+                else:
+                    response = await self.process_message(client_id, message)
                     
-                try:
-                    message = json.loads(message_data.decode('utf-8'))
-                    response = self.process_message(client_id, message)
-                    self.send_response(socket, response)
-                except json.JSONDecodeError:
-                    error_response = {
-                        'status': 'error',
-                        'message': 'Invalid JSON format'
-                    }
-                    self.send_response(socket, error_response)
+                # File downloads send their own binary frame
+                if response is not None:
+                    await self.send_response(writer, response)
                     
+        except asyncio.IncompleteReadError:
+            pass  # Client went away mid-frame
         except Exception as e:
             print(f"Error handling client {client_id}: {e}")
         finally:
             self.disconnect_client(client_id)
             
-    def process_message(self, client_id, message):
+    @staticmethod
+    def tune_connection(writer):
+        """Size socket buffers for bulk transfers and keep small frames unbuffered"""
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except OSError:
+                pass  # Not fatal; the kernel defaults still work
+        # Let drain() wait only once a full socket buffer is queued
+        writer.transport.set_write_buffer_limits(high=SOCKET_BUFFER_SIZE)
+        
+    def run_io(self, func, *args):
+        """Run a blocking file operation on the I/O pool; returns an awaitable"""
+        return asyncio.get_running_loop().run_in_executor(self.io_pool, func, *args)
+        
+    @staticmethod
+    def open_temp_file(room_dir):
+        """Create a uniquely named upload file in room_dir; returns (file, path)"""
+        os.makedirs(room_dir, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(prefix='.upload-', suffix='.part', dir=room_dir)
+        return os.fdopen(fd, 'wb'), temp_path
+        
+    @staticmethod
+    def write_chunk(f, digest, chunk):
+        """Hash and write one payload chunk (runs on a worker thread)"""
+        digest.update(chunk)
+        f.write(chunk)
+        
+    async def receive_payload(self, reader, f, size, digest=None):
+        """Stream size payload bytes from the reader into f (discarded if f is None)"""
+        remaining = size
+        while remaining:
+            # Take whatever the stream buffer already holds instead of
+            # waiting for (and joining) a full chunk
+            chunk = await reader.read(min(FILE_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', remaining)
+            if f is not None:
+                # Disk writes run off the event loop so other clients keep flowing
+                if digest is not None:
+                    await self.run_io(self.write_chunk, f, digest, chunk)
+                else:
+                    await self.run_io(f.write, chunk)
+            remaining -= len(chunk)
+            
+    async def process_message(self, client_id, message):
         """Process incoming client message"""
         msg_type = message.get('type')
         client = self.clients[client_id]
@@ -140,26 +201,28 @@ class FileSharingServer:
         if msg_type == 'set_username':
             username = message.get('username')
             if username:
-                client['username'] = username
+                client.username = intern_string(username)
                 return {'status': 'success', 'message': 'Username set'}
             else:
                 return {'status': 'error', 'message': 'Invalid username'}
                 
         elif msg_type == 'join_room':
             room_name = message.get('room')
-            if room_name and room_name in self.rooms:
+            rooms = self.rooms
+            new_room = rooms.get(room_name) if room_name else None
+            if new_room is not None:
                 # Leave current room if any
-                if client['room']:
-                    self.rooms[client['room']]['users'].discard(client_id)
+                if client.room:
+                    rooms[client.room]['users'].discard(client_id)
                 
-                # Join new room
-                client['room'] = room_name
-                self.rooms[room_name]['users'].add(client_id)
+                # Join new room; share the interned key rather than this message's copy
+                client.room = intern_string(room_name)
+                new_room['users'].add(client_id)
                 
                 return {
                     'status': 'success',
                     'message': f'Joined room {room_name}',
-                    'room_files': list(self.rooms[room_name]['files'].keys())
+                    'room_files': list(new_room['files'])
                 }
             else:
                 return {'status': 'error', 'message': 'Room not found'}
@@ -167,7 +230,8 @@ class FileSharingServer:
         elif msg_type == 'create_room':
             room_name = message.get('room')
             if room_name and room_name not in self.rooms:
-                self.rooms[room_name] = {'files': {}, 'users': set()}
+                room_name = intern_string(room_name)
+                self.rooms[room_name] = {'files': {}, 'users': set(), 'files_cache': None}
                 return {'status': 'success', 'message': f'Room {room_name} created'}
             else:
                 return {'status': 'error', 'message': 'Room already exists or invalid name'}
@@ -179,25 +243,27 @@ class FileSharingServer:
             }
             
         elif msg_type == 'list_files':
-            room = client['room']
+            room = client.room
             if room and room in self.rooms:
-                files_info = []
-                for filename, file_info in self.rooms[room]['files'].items():
-                    files_info.append({
-                        'name': filename,
-                        'size': file_info['size'],
-                        'uploaded_by': file_info['uploaded_by'],
-                        'uploaded_at': file_info['uploaded_at']
-                    })
-                return {'status': 'success', 'files': files_info}
+                # Serialized listing is cached until the room's files change
+                room_data = self.rooms[room]
+                if room_data['files_cache'] is None:
+                    files_info = []
+                    for filename, file_info in room_data['files'].items():
+                        files_info.append({
+                            'name': filename,
+                            'size': file_info['size'],
+                            'uploaded_by': file_info['uploaded_by'],
+                            'uploaded_at': file_info['uploaded_at'],
+                            'sha256': file_info['sha256']
+                        })
+                    room_data['files_cache'] = dumps({'status': 'success', 'files': files_info})
+                return room_data['files_cache']
             else:
                 return {'status': 'error', 'message': 'Not in a room'}
                 
-        elif msg_type == 'upload_file':
-            return self.handle_file_upload(client_id, message)
-            
         elif msg_type == 'download_file':
-            return self.handle_file_download(client_id, message)
+            return await self.handle_file_download(client_id, message)
             
         else:
             return {'status': 'error', 'message': 'Unknown message type'}
@@ -208,12 +274,11 @@ class FileSharingServer:
             return False, "Invalid filename"
             
         # Check for blocked patterns
-        for pattern in self.blocked_patterns:
-            if pattern in filename:
-                return False, f"Filename contains invalid character: {pattern}"
-                
+        match = self._blocked_re.search(filename)
+        if match:
+            return False, f"Filename contains invalid character: {match.group(0)}"
+            
         # Check extension
-        import os
         _, ext = os.path.splitext(filename.lower())
         if ext not in self.allowed_extensions:
             return False, f"File type {ext} not allowed"
@@ -224,74 +289,94 @@ class FileSharingServer:
             
         return True, "Valid filename"
         
-    def handle_file_upload(self, client_id, message):
-        """Handle file upload request"""
-        client = self.clients[client_id]
-        room = client['room']
-        
-        if not room:
-            return {'status': 'error', 'message': 'Not in a room'}
-            
+    def validate_upload(self, room, message, payload_size):
+        """Check an upload header before any payload bytes are read; returns an error or None"""
         filename = message.get('filename')
         file_size = message.get('size')
-        file_data = message.get('data')
         
-        if not all([filename, file_size is not None, file_data]):
-            return {'status': 'error', 'message': 'Missing file information'}
-            
-        # Validate file size
+        if not room:
+            return 'Not in a room'
+        if not filename or file_size is None:
+            return 'Missing file information'
+        if file_size != payload_size:
+            return 'File size mismatch'
         if file_size > self.max_file_size:
-            return {'status': 'error', 'message': f'File too large (max {self.max_file_size // (1024*1024)}MB)'}
+            return f'File too large (max {self.max_file_size // (1024*1024)}MB)'
+        checksum = message.get('sha256')
+        if checksum is not None and not (type(checksum) is str and len(checksum) == 64):
+            return 'Invalid sha256 checksum'
             
-        # Validate filename
         is_valid, validation_msg = self.validate_filename(filename)
         if not is_valid:
-            return {'status': 'error', 'message': validation_msg}
+            return validation_msg
+        return None
+        
+    async def handle_file_upload(self, client_id, message, reader, payload_size):
+        """Handle file upload frame, consuming its payload from the reader"""
+        client = self.clients[client_id]
+        room = client.room
+        filename = message.get('filename')
+        file_size = message.get('size')
+        
+        error = self.validate_upload(room, message, payload_size)
+        if error:
+            # Drain the payload so the next frame stays aligned
+            await self.receive_payload(reader, None, payload_size)
+            return {'status': 'error', 'message': error}
             
-        # Additional validation: check if base64 data size matches expected size
+        # Stream into a private temp file; the stored copy (if any) is only
+        # replaced once the whole upload has arrived and checked out
+        room_dir = os.path.join(self.storage_dir, room)
+        file_path = os.path.join(room_dir, filename)
         try:
-            import base64
-            decoded_content = base64.b64decode(file_data)
-            actual_size = len(decoded_content)
-            if actual_size != file_size:
-                return {'status': 'error', 'message': 'File size mismatch'}
+            f, temp_path = await self.run_io(self.open_temp_file, room_dir)
         except Exception as e:
-            return {'status': 'error', 'message': f'Invalid file data: {str(e)}'}
+            await self.receive_payload(reader, None, payload_size)
+            return {'status': 'error', 'message': f'Upload failed: {str(e)}'}
             
+        # Hash inline as bytes arrive; hashlib drops the GIL for large chunks
+        digest = hashlib.sha256()
         try:
-            # Save file to storage
-            room_dir = os.path.join(self.storage_dir, room)
-            if not os.path.exists(room_dir):
-                os.makedirs(room_dir)
-                
-            file_path = os.path.join(room_dir, filename)
+            with f:
+                await self.receive_payload(reader, f, payload_size, digest)
+        except BaseException:
+            # A partial file is useless; the connection is gone anyway
+            os.remove(temp_path)
+            raise
             
-            # Decode base64 data and save
-            import base64
-            file_content = base64.b64decode(file_data)
-            with open(file_path, 'wb') as f:
-                f.write(file_content)
-                
-            # Update room file list
-            self.rooms[room]['files'][filename] = {
-                'size': file_size,
-                'uploaded_by': client['username'] or client_id,
-                'uploaded_at': datetime.now().isoformat(),
-                'path': file_path
-            }
+        checksum = digest.hexdigest()
+        expected = message.get('sha256')
+        if expected and expected.lower() != checksum:
+            os.remove(temp_path)
+            return {'status': 'error', 'message': f'Checksum mismatch for {filename}'}
             
-            return {
-                'status': 'success',
-                'message': f'File {filename} uploaded successfully'
-            }
-            
-        except Exception as e:
+        try:
+            await self.run_io(os.replace, temp_path, file_path)
+        except OSError as e:
+            os.remove(temp_path)
             return {'status': 'error', 'message': f'Upload failed: {str(e)}'}
             
-    def handle_file_download(self, client_id, message):
-        """Handle file download request"""
+        # Update room file list
+        room_data = self.rooms[room]
+        files = room_data['files']
+        files[filename] = {
+            'size': file_size,
+            'uploaded_by': client.username or client_id,
+            'uploaded_at': datetime.now().isoformat(),
+            'path': file_path,
+            'sha256': checksum
+        }
+        room_data['files_cache'] = None
+        
+        return {
+            'status': 'success',
+            'message': f'File {filename} uploaded successfully'
+        }
+            
+    async def handle_file_download(self, client_id, message):
+        """Handle file download request, streaming the file as a binary frame"""
         client = self.clients[client_id]
-        room = client['room']
+        room = client.room
         
         if not room:
             return {'status': 'error', 'message': 'Not in a room'}
@@ -300,38 +385,57 @@ class FileSharingServer:
         if not filename:
             return {'status': 'error', 'message': 'Filename required'}
             
-        if filename not in self.rooms[room]['files']:
+        file_info = self.rooms[room]['files'].get(filename)
+        if file_info is None:
             return {'status': 'error', 'message': 'File not found'}
             
         try:
-            file_info = self.rooms[room]['files'][filename]
-            file_path = file_info['path']
-            
-            # Read file and encode in base64
-            import base64
-            with open(file_path, 'rb') as f:
-                file_content = f.read()
-                
-            encoded_data = base64.b64encode(file_content).decode('utf-8')
+            f = await self.run_io(open, file_info['path'], 'rb')
+        except Exception as e:
+            return {'status': 'error', 'message': f'Download failed: {str(e)}'}
             
-            return {
+        with f:
+            file_size = os.fstat(f.fileno()).st_size
+            header = {
                 'status': 'success',
+                'type': 'download_file',
                 'filename': filename,
-                'size': file_info['size'],
-                'data': encoded_data
+                'size': file_size,
+                'sha256': file_info['sha256']
             }
+            header_json = dumps(header)
             
-        except Exception as e:
-            return {'status': 'error', 'message': f'Download failed: {str(e)}'}
+            writer = client.writer
+            writer.writelines((
+                FRAME_HDR.pack(OP_FILE, len(header_json)),
+                header_json,
+                SIZE_FIELD.pack(file_size)
+            ))
+            if file_size:
+                try:
+                    # Zero-copy: the kernel moves page cache straight to the socket
+                    await asyncio.get_running_loop().sendfile(
+                        writer.transport, f, 0, file_size, fallback=False
+                    )
+                except (NotImplementedError, asyncio.SendfileNotAvailableError):
+                    # No native sendfile (e.g. uvloop); nothing was sent yet
+                    while True:
+                        chunk = await self.run_io(f.read, FILE_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        writer.write(chunk)
+                        await writer.drain()
+            await writer.drain()
+                
+        return None
             
-    def send_response(self, socket, response):
-        """Send response to client"""
-        response_json = json.dumps(response).encode('utf-8')
-        length = len(response_json)
+    async def send_response(self, writer, response):
+        """Send response to client (dict, or already-encoded JSON bytes)"""
+        response_json = response if isinstance(response, bytes) else dumps(response)
         
-        # Send length first, then data
-        socket.send(length.to_bytes(4, byteorder='big'))
-        socket.send(response_json)
+        # Opcode, length and data go out as one frame
+        writer.writelines((FRAME_HDR.pack(OP_JSON, len(response_json)), response_json))
+        await writer.drain()
         
     def shutdown_server(self):
         """Clean shutdown of the server"""
@@ -343,34 +447,29 @@ class FileSharingServer:
         for client_id in client_ids:
             self.disconnect_client(client_id)
             
-        # Close server socket
-        if self.server_socket:
-            try:
-                self.server_socket.close()
-            except:
-                pass
-            self.server_socket = None
+        # Stop accepting connections
+        if self.server:
+            self.server.close()
+            self.server = None
             
+        self.io_pool.shutdown(wait=False)
+        
         print("🔴 [SERVER] Server shutdown complete")
         
     def disconnect_client(self, client_id):
         """Handle client disconnection"""
-        if client_id in self.clients:
-            client = self.clients[client_id]
-            
+        client = self.clients.pop(client_id, None)
+        if client is not None:
             # Remove from room
-            if client['room']:
-                self.rooms[client['room']]['users'].discard(client_id)
+            if client.room:
+                self.rooms[client.room]['users'].discard(client_id)
                 
-            # Close socket
+            # Close connection; a handler blocked on read sees EOF
             try:
-                client['socket'].shutdown(socket.SHUT_RDWR)
-                client['socket'].close()
+                client.writer.close()
             except:
                 pass
                 
-            # Remove client
-            del self.clients[client_id]
             print(f"Client {client_id} disconnected")
 
 if __name__ == "__main__":
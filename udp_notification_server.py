@@ -6,19 +6,109 @@ Handles real-time notifications and user presence tracking
 
 import socket
 import threading
-import json
 import time
+import heapq
+import sys
+import os
+import ctypes
+import struct
+from dataclasses import dataclass
 from datetime import datetime
 
+from protocol import dumps, loads, intern_string, UDP_HEARTBEAT, CLIENT_TIMEOUT
+
+
+def _load_sendmmsg():
+    """Wrap Linux sendmmsg(2) so one syscall can send a datagram to many IPv4 peers"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc_sendmmsg = ctypes.CDLL(None, use_errno=True).sendmmsg
+    except (OSError, AttributeError):
+        return None
+        
+    class IOVec(ctypes.Structure):
+        _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+        
+    class SockAddrIn(ctypes.Structure):
+        _fields_ = [('sin_family', ctypes.c_ushort), ('sin_port', ctypes.c_uint16),
+                    ('sin_addr', ctypes.c_uint32), ('sin_zero', ctypes.c_char * 8)]
+                    
+    class MsgHdr(ctypes.Structure):
+        _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                    ('msg_iov', ctypes.POINTER(IOVec)), ('msg_iovlen', ctypes.c_size_t),
+                    ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                    ('msg_flags', ctypes.c_int)]
+                    
+    class MMsgHdr(ctypes.Structure):
+        _fields_ = [('msg_hdr', MsgHdr), ('msg_len', ctypes.c_uint)]
+        
+    libc_sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    libc_sendmmsg.restype = ctypes.c_int
+    
+    def sendmmsg(sock, data, addrs):
+        """Send data to each (ip, port) in addrs; returns how many were sent
+
+        The batch stops before the first address that cannot be packed as an
+        IPv4 sockaddr, so the caller can handle that peer on its own.
+        """
+        count = len(addrs)
+        payload = ctypes.create_string_buffer(data, len(data))
+        iov = IOVec(ctypes.addressof(payload), len(data))
+        names = (SockAddrIn * count)()
+        msgs = (MMsgHdr * count)()
+        for i, addr in enumerate(addrs):
+            name = names[i]
+            try:
+                ip, port = addr
+                name.sin_port = socket.htons(port)
+                # inet_aton is already network order; store its bytes as-is
+                name.sin_addr = struct.unpack('=I', socket.inet_aton(ip))[0]
+            except (OSError, ValueError, TypeError, OverflowError):
+                count = i
+                break
+            name.sin_family = socket.AF_INET
+            hdr = msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(name)
+            hdr.msg_namelen = ctypes.sizeof(SockAddrIn)
+            hdr.msg_iov = ctypes.pointer(iov)
+            hdr.msg_iovlen = 1
+        if not count:
+            return 0
+        sent = libc_sendmmsg(sock.fileno(), msgs, count, 0)
+        if sent < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return sent
+        
+    return sendmmsg
+
+_sendmmsg = _load_sendmmsg()
+
+@dataclass(slots=True)
+class Client:
+    """A registered notification client"""
+    address: tuple
+    username: str
+    room: str
+    last_heartbeat: float  # time.monotonic() of the last heartbeat
+
 class NotificationServer:
     def __init__(self, host='127.0.0.1', port=65433):
         self.host = host
         self.port = port
-        self.clients = {}  # client_id -> {'address': (ip, port), 'username': str, 'room': str, 'last_heartbeat': float}
+        self.clients = {}  # client_id -> Client
         self.rooms = {
-            'general': set()  # set of client_ids
+            # members: set of client_ids; usernames: kept in step so listings need no lookups;
+            # recipients/addresses: scratch lists reused by every broadcast to the room
+            'general': self.new_room()
         }
         self.client_id_counter = 0
+        self.timestamp_cache = (0, '')  # (whole second, ISO string) shared by every message
+        # Min-heap of (expiry, client_id), checked lazily against last_heartbeat
+        self.expiry_heap = []
+        # Guards clients, rooms and expiry_heap; shared by the receive loop and the cleanup thread
+        self.lock = threading.RLock()
         self.running = True
         self.server_socket = None
         self.cleanup_thread = None
@@ -41,13 +131,17 @@ class NotificationServer:
             while self.running:
                 try:
                     data, addr = self.server_socket.recvfrom(4096)
+                    if data and data[0] == UDP_HEARTBEAT:
+                        # Fast path: no JSON parse and no logging for keep-alives
+                        self.touch_client(data[1:].decode('utf-8', 'replace'))
+                        continue
                     print(f"🟢 [UDP SERVER] Received from {addr}: {data}")  # Debug
                     
                     try:
-                        message = json.loads(data.decode('utf-8'))
+                        message = loads(data)
                         print(f"🟢 [UDP SERVER] Parsed message: {message}")  # Debug
                         self.process_message(message, addr, self.server_socket)
-                    except json.JSONDecodeError:
+                    except ValueError:  # Bad JSON or bad UTF-8
                         print(f"🔴 [UDP SERVER] Invalid JSON from {addr}")
                         
                 except socket.timeout:
@@ -67,9 +161,10 @@ class NotificationServer:
         self.running = False
         
         # Clear all clients
-        client_ids = list(self.clients.keys())
-        for client_id in client_ids:
-            self.remove_client(client_id)
+        with self.lock:
+            client_ids = list(self.clients.keys())
+            for client_id in client_ids:
+                self.remove_client(client_id)
             
         # Close server socket
         if self.server_socket:
@@ -88,41 +183,43 @@ class NotificationServer:
         client_id = message.get('client_id')
         
         if msg_type == 'register':
-            # Register new client
-            username = message.get('username', 'Anonymous')
-            room = message.get('room', 'general')
+            # Register new client; interned so every record and user list shares one copy
+            client_id = intern_string(client_id)
+            username = intern_string(message.get('username', 'Anonymous'))
+            room = intern_string(message.get('room', 'general'))
             client_udp_port = message.get('udp_port')  # Get the client's UDP port
             
-            if client_id not in self.clients:
-                self.client_id_counter += 1
-                if not client_id:
-                    client_id = f"client_{self.client_id_counter}"
-                    
             # Update the client's address to include the correct UDP port
-            if client_udp_port:
+            if type(client_udp_port) is int and 0 < client_udp_port < 65536:
                 client_addr = (addr[0], client_udp_port)
             else:
                 client_addr = addr
                 
-            self.clients[client_id] = {
-                'address': client_addr,
-                'username': username,
-                'room': room,
-                'last_heartbeat': time.time()
-            }
-            
-            # Add to room
-            if room not in self.rooms:
-                self.rooms[room] = set()
-            self.rooms[room].add(client_id)
-            
+            with self.lock:
+                clients = self.clients
+                previous = clients.get(client_id)
+                if previous is None:
+                    self.client_id_counter += 1
+                    if not client_id:
+                        client_id = f"client_{self.client_id_counter}"
+                    heapq.heappush(self.expiry_heap, (time.monotonic() + CLIENT_TIMEOUT, client_id))
+                else:
+                    # Re-registering replaces the old entry and its room membership
+                    self.leave_room(client_id, previous.room, previous.username)
+                    
+                clients[client_id] = Client(client_addr, username, room, time.monotonic())
+                
+                # Add to room
+                self.enter_room(client_id, room, username)
+                users = self.get_room_users(room)
+                
             # Broadcast welcome message to all clients in room (including new user)
             welcome_msg = {
                 'type': 'notification',
                 'message': f'{username} joined the room',
                 'room': room,
-                'timestamp': datetime.now().isoformat(),
-                'users': self.get_room_users(room)
+                'timestamp': self.now_iso(),
+                'users': users
             }
             self.broadcast_to_room(room, welcome_msg, server_socket)
             
@@ -130,53 +227,57 @@ class NotificationServer:
             room_info = {
                 'type': 'room_info',
                 'room': room,
-                'users': self.get_room_users(room),
-                'timestamp': datetime.now().isoformat()
+                'users': users,
+                'timestamp': self.now_iso()
             }
             self.send_to_client(client_id, room_info, server_socket)
             
         elif msg_type == 'unregister':
             # Handle client unregistration
-            if client_id in self.clients:
-                self.remove_client(client_id)
+            self.remove_client(client_id)
                 
         elif msg_type == 'heartbeat':
-            # Update client heartbeat
-            if client_id in self.clients:
-                self.clients[client_id]['last_heartbeat'] = time.time()
+            # Update client heartbeat (JSON form, kept for older clients)
+            self.touch_client(client_id)
                 
         elif msg_type == 'join_room':
             # Handle room change
-            new_room = message.get('room')
-            if client_id in self.clients and new_room:
-                old_room = self.clients[client_id]['room']
-                username = self.clients[client_id]['username']
-                
-                # Leave old room
-                if old_room in self.rooms:
-                    self.rooms[old_room].discard(client_id)
+            new_room = intern_string(message.get('room'))
+            with self.lock:
+                client = self.clients.get(client_id)
+                if client and new_room:
+                    old_room = client.room
+                    username = client.username
+                    
+                    # Leave old room
+                    old_users = None
+                    if old_room in self.rooms:
+                        self.leave_room(client_id, old_room, username)
+                        old_users = self.get_room_users(old_room)
+                        
+                    # Join new room
+                    client.room = new_room
+                    self.enter_room(client_id, new_room, username)
+                    new_users = self.get_room_users(new_room)
+                    
+            if client and new_room:
+                if old_users is not None:
                     leave_msg = {
                         'type': 'notification',
                         'message': f'{username} left the room',
                         'room': old_room,
-                        'timestamp': datetime.now().isoformat(),
-                        'users': self.get_room_users(old_room)
+                        'timestamp': self.now_iso(),
+                        'users': old_users
                     }
                     self.broadcast_to_room(old_room, leave_msg, server_socket)
                 
-                # Join new room
-                self.clients[client_id]['room'] = new_room
-                if new_room not in self.rooms:
-                    self.rooms[new_room] = set()
-                self.rooms[new_room].add(client_id)
-                
                 # Broadcast join message to all clients in room (including new user)
                 join_msg = {
                     'type': 'notification',
                     'message': f'{username} joined the room',
                     'room': new_room,
-                    'timestamp': datetime.now().isoformat(),
-                    'users': self.get_room_users(new_room)
+                    'timestamp': self.now_iso(),
+                    'users': new_users
                 }
                 self.broadcast_to_room(new_room, join_msg, server_socket)
                 
@@ -184,16 +285,20 @@ class NotificationServer:
                 room_info = {
                     'type': 'room_info',
                     'room': new_room,
-                    'users': self.get_room_users(new_room),
-                    'timestamp': datetime.now().isoformat()
+                    'users': new_users,
+                    'timestamp': self.now_iso()
                 }
                 self.send_to_client(client_id, room_info, server_socket)
                 
         elif msg_type == 'file_notification':
             # Broadcast file activity
-            if client_id in self.clients:
-                room = self.clients[client_id]['room']
-                username = self.clients[client_id]['username']
+            with self.lock:
+                client = self.clients.get(client_id)
+                if client:
+                    room = client.room
+                    username = client.username
+                    users = self.get_room_users(room)
+            if client:
                 action = message.get('action')  # 'upload', 'download'
                 filename = message.get('filename')
                 
@@ -201,16 +306,19 @@ class NotificationServer:
                     'type': 'notification',
                     'message': f'{username} {action}ed {filename}',
                     'room': room,
-                    'timestamp': datetime.now().isoformat(),
-                    'users': self.get_room_users(room)
+                    'timestamp': self.now_iso(),
+                    'users': users
                 }
                 self.broadcast_to_room(room, notification, server_socket)
                 
         elif msg_type == 'chat_message':
             # Handle chat messages (optional feature)
-            if client_id in self.clients:
-                room = self.clients[client_id]['room']
-                username = self.clients[client_id]['username']
+            with self.lock:
+                client = self.clients.get(client_id)
+                if client:
+                    room = client.room
+                    username = client.username
+            if client:
                 chat_content = message.get('message', '')
                 
                 chat_msg = {
@@ -218,41 +326,110 @@ class NotificationServer:
                     'username': username,
                     'message': chat_content,
                     'room': room,
-                    'timestamp': datetime.now().isoformat()
+                    'timestamp': self.now_iso()
                 }
                 self.broadcast_to_room(room, chat_msg, server_socket)
                 
+    def touch_client(self, client_id):
+        """Record a heartbeat from a client"""
+        with self.lock:
+            client = self.clients.get(client_id)
+            if client:
+                client.last_heartbeat = time.monotonic()
+                
+    def now_iso(self):
+        """Current time as an ISO string, formatted at most once per second"""
+        now = int(time.time())
+        second, text = self.timestamp_cache
+        if now != second:
+            text = datetime.fromtimestamp(now).isoformat()
+            self.timestamp_cache = (now, text)
+        return text
+        
+    @staticmethod
+    def new_room():
+        """Empty room record"""
+        return {'members': set(), 'usernames': [], 'recipients': [], 'addresses': []}
+        
+    def enter_room(self, client_id, room, username):
+        """Add a client to a room, creating the room if needed (caller holds the lock)"""
+        room_data = self.rooms.get(room)
+        if room_data is None:
+            room_data = self.rooms[room] = self.new_room()
+        members = room_data['members']
+        if client_id not in members:
+            members.add(client_id)
+            room_data['usernames'].append(username)
+            
+    def leave_room(self, client_id, room, username):
+        """Remove a client from a room (caller holds the lock)"""
+        room_data = self.rooms.get(room)
+        if room_data and client_id in room_data['members']:
+            room_data['members'].discard(client_id)
+            room_data['usernames'].remove(username)
+            
     def get_room_users(self, room):
         """Get list of users in a room"""
-        users = []
-        if room in self.rooms:
-            for client_id in self.rooms[room]:
-                if client_id in self.clients:
-                    users.append(self.clients[client_id]['username'])
-        return users
+        with self.lock:
+            room_data = self.rooms.get(room)
+            if room_data is not None:
+                # Copy so the message can be encoded outside the lock
+                return list(room_data['usernames'])
+        return []
         
     def broadcast_to_room(self, room, message, server_socket, exclude_client=None):
         """Broadcast message to all clients in a room"""
-        if room not in self.rooms:
-            return
-            
-        message_json = json.dumps(message).encode('utf-8')
+        # Snapshot recipients into the room's reused buffers under the lock;
+        # only the receive loop broadcasts, so the buffers are never shared
+        with self.lock:
+            room_data = self.rooms.get(room)
+            if room_data is None:
+                return
+            clients = self.clients
+            recipients = room_data['recipients']
+            addrs = room_data['addresses']
+            recipients.clear()
+            addrs.clear()
+            for client_id in room_data['members']:
+                client = clients.get(client_id)
+                if client is not None and client_id != exclude_client:
+                    recipients.append(client_id)
+                    addrs.append(client.address)
+                    
+        message_json = dumps(message)
         
-        for client_id in self.rooms[room].copy():
-            if client_id != exclude_client and client_id in self.clients:
+        if _sendmmsg is None:
+            # A peer removed since the snapshot is skipped by send_to_client
+            for client_id in recipients:
                 self.send_to_client(client_id, message_json, server_socket)
+            return
+            
+        # Batch the whole room into as few sendmmsg calls as possible
+        i = 0
+        while i < len(recipients):
+            try:
+                sent = _sendmmsg(server_socket, message_json, addrs[i:] if i else addrs)
+            except OSError:
+                sent = 0
+            if not sent:
+                # Let the per-client path retry, report and drop the failing peer
+                # (a send error, or an address sendmmsg could not pack)
+                self.send_to_client(recipients[i], message_json, server_socket)
+                sent = 1
+            i += sent
                 
     def send_to_client(self, client_id, message, server_socket):
         """Send message to specific client"""
-        if client_id in self.clients:
-            client = self.clients[client_id]
-            addr = client['address']
+        with self.lock:
+            client = self.clients.get(client_id)
+        if client:
+            addr = client.address
             
             try:
                 if isinstance(message, str):
                     message = message.encode('utf-8')
                 elif isinstance(message, dict):
-                    message = json.dumps(message).encode('utf-8')
+                    message = dumps(message)
                     
                 server_socket.sendto(message, addr)
             except Exception as e:
@@ -264,15 +441,22 @@ class NotificationServer:
         """Remove inactive clients (no heartbeat for 30 seconds)"""
         while self.running:
             try:
-                current_time = time.time()
-                inactive_clients = []
+                current_time = time.monotonic()
                 
-                for client_id, client in self.clients.items():
-                    if current_time - client['last_heartbeat'] > 30:
-                        inactive_clients.append(client_id)
-                        
-                for client_id in inactive_clients:
-                    self.remove_client(client_id)
+                # Only entries that have come due are looked at; clients that
+                # sent a heartbeat since are pushed back with their new deadline
+                with self.lock:
+                    heap = self.expiry_heap
+                    while heap and heap[0][0] <= current_time:
+                        _, client_id = heapq.heappop(heap)
+                        client = self.clients.get(client_id)
+                        if client is None:
+                            continue
+                        expiry = client.last_heartbeat + CLIENT_TIMEOUT
+                        if expiry <= current_time:
+                            self.remove_client(client_id)
+                        else:
+                            heapq.heappush(heap, (expiry, client_id))
                     
                 time.sleep(10)  # Check every 10 seconds
                 
@@ -281,18 +465,17 @@ class NotificationServer:
                 
     def remove_client(self, client_id):
         """Remove client from all rooms and client list"""
-        if client_id in self.clients:
-            client = self.clients[client_id]
-            room = client['room']
-            username = client['username']
+        with self.lock:
+            client = self.clients.pop(client_id, None)
+            if client is None:
+                return
+            room = client.room
+            username = client.username
             
             # Remove from room
-            if room in self.rooms:
-                self.rooms[room].discard(client_id)
+            self.leave_room(client_id, room, username)
                 
-            # Remove client
-            del self.clients[client_id]
-            print(f"Client {client_id} ({username}) removed due to inactivity")
+        print(f"Client {client_id} ({username}) removed due to inactivity")
 
 if __name__ == "__main__":
     server = NotificationServer()